@@ -10,16 +10,22 @@ import os
 import sys
 import argparse
 import getpass
+import atexit
 import logging
 import sqlite3
+import random
+import queue
+import threading
 from datetime import datetime
 import time
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from PIL import Image
-from tqdm import tqdm
-from pyicloud import PyiCloudService
+# Pillow, tqdm, pyicloud and requests are imported where they are used so
+# that --stats, --list and --clear start without loading them
 
 # Default log file paths
 DEFAULT_TODO_DB = 'todo_uploads.db'
@@ -29,21 +35,132 @@ DEFAULT_GENERAL_LOG = 'icloud_upload.log'
 TODO_DB = DEFAULT_TODO_DB
 GENERAL_LOG = DEFAULT_GENERAL_LOG
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
+logger = logging.getLogger(__name__)
+
+# Uploads are network bound, so use well more threads than cores
+DEFAULT_THREADS = min(32, (os.cpu_count() or 4) * 4)
+
+# Retry policy for transient upload failures; upload_photo() is the only layer that retries
+UPLOAD_ATTEMPTS = 5
+MAX_RETRY_DELAY = 60
+# Uploads are non-idempotent POSTs, so only retry responses where iCloud explicitly
+# rejected the request without storing it. Gateway errors (502/504) are not retried
+# because the photo may already have been saved. 421/450/500 are not retried either:
+# pyicloud has already re-sent the request once on those before raising.
+RETRYABLE_ERROR_CODES = (429, 503, 'ACCESS_DENIED')
+
+# Listener that writes queued log records, started once by configure_logging()
+_log_listener = None
+
+def configure_logging(general_log, verbose=False):
+    """Configure console and file logging once the log file path is known."""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    handlers = [
         logging.StreamHandler(),
-        logging.FileHandler(GENERAL_LOG)
+        # Defer opening the log file until the first record is written
+        logging.FileHandler(general_log, delay=True)
     ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    # Upload threads only enqueue records; a listener thread does the actual I/O
+    log_queue = queue.Queue()
+    _log_listener = QueueListener(log_queue, *handlers)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+    
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(QueueHandler(log_queue))
+    
+    if verbose:
+        logger.setLevel(logging.DEBUG)
+
+def flush_logging():
+    """Wait until every queued log record is written, e.g. before prompting the user."""
+    if _log_listener is not None:
+        # stop() drains the queue and joins the listener thread
+        _log_listener.stop()
+        _log_listener.start()
+
+# Connection settings applied to every todo database connection
+DB_PRAGMAS = (
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA temp_store=MEMORY",
 )
-logger = logging.getLogger(__name__)
+# Settings that only the writer connection may change
+WRITER_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+)
+
+class ConnectionPool:
+    """A single serialized writer plus a pool of read-only todo database connections."""
+
+    def __init__(self, db_path, max_readers=None):
+        # Open the writer first so the database file exists and is in WAL mode
+        self._writer = self._connect(db_path, WRITER_PRAGMAS + DB_PRAGMAS)
+        self._write_lock = threading.Lock()
+        self._reader_uri = Path(db_path).resolve().as_uri() + '?mode=ro'
+        self._idle_readers = queue.Queue(maxsize=max_readers or os.cpu_count() or 1)
+
+    @staticmethod
+    def _connect(database, pragmas, **kwargs):
+        conn = sqlite3.connect(database, check_same_thread=False, **kwargs)
+        for pragma in pragmas:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def writer(self):
+        """Yield the writer connection inside a BEGIN IMMEDIATE transaction."""
+        with self._write_lock:
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+                # Commit inside the try so a failed commit also rolls back and
+                # leaves the shared connection ready for the next transaction
+                self._writer.commit()
+            except BaseException:
+                self._writer.rollback()
+                raise
+
+    @contextmanager
+    def reader(self):
+        """Check a read-only connection out of the pool for the duration of the block."""
+        try:
+            conn = self._idle_readers.get_nowait()
+        except queue.Empty:
+            conn = self._connect(self._reader_uri, DB_PRAGMAS, uri=True)
+        try:
+            yield conn
+        finally:
+            try:
+                self._idle_readers.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+# Todo database connection pool, created lazily by get_pool()
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the todo database connection pool, creating it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(TODO_DB)
+        return _pool
 
 def init_database():
     """Initialize SQLite database with necessary tables."""
     try:
-        with sqlite3.connect(TODO_DB) as conn:
+        with get_pool().writer() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS todo_photos (
@@ -53,45 +170,96 @@ def init_database():
                     status TEXT DEFAULT 'pending'
                 )
             ''')
-            conn.commit()
+            # Covers the pending-photo lookup and the per-status counts
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_todo_photos_status
+                ON todo_photos (status, photo_path)
+            ''')
     except Exception as e:
         logger.error(f"Error initializing database: {e}")
         sys.exit(1)
 
+# Completed uploads are queued and committed in batches by one writer thread
+COMPLETION_BATCH_SIZE = 256
+COMPLETION_FLUSH_INTERVAL = 0.5
+_completion_queue = queue.Queue()
+
 def remove_from_todo(photo_path):
-    """Remove a successfully uploaded photo path from the todo database."""
+    """Queue a successfully uploaded photo path to be marked completed in the todo database."""
+    _completion_queue.put(str(photo_path))
+
+def _mark_completed(photo_paths):
+    """Mark a batch of uploaded photo paths as completed in a single transaction."""
     try:
-        with sqlite3.connect(TODO_DB) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
+        with get_pool().writer() as conn:
+            conn.executemany(
                 "UPDATE todo_photos SET status = 'completed' WHERE photo_path = ?",
-                (str(photo_path),)
+                ((photo_path,) for photo_path in photo_paths)
             )
-            conn.commit()
     except Exception as e:
-        logger.error(f"Error removing {photo_path} from todo database: {e}")
+        logger.error(f"Error removing {len(photo_paths)} photos from todo database: {e}")
+
+def _completion_writer():
+    """Drain the completion queue until a None sentinel arrives, writing in batches."""
+    while True:
+        photo_path = _completion_queue.get()
+        batch = []
+        deadline = time.monotonic() + COMPLETION_FLUSH_INTERVAL
+        while photo_path is not None:
+            batch.append(photo_path)
+            timeout = deadline - time.monotonic()
+            if len(batch) >= COMPLETION_BATCH_SIZE or timeout <= 0:
+                break
+            try:
+                photo_path = _completion_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+        
+        if batch:
+            _mark_completed(batch)
+        if photo_path is None:
+            return
+
+def start_completion_writer():
+    """Start the background thread that records completed uploads."""
+    writer = threading.Thread(target=_completion_writer, name="completion-writer", daemon=True)
+    writer.start()
+    return writer
+
+def stop_completion_writer(writer):
+    """Flush any queued completions and wait for the writer thread to exit."""
+    _completion_queue.put(None)
+    writer.join()
+
+# Rows inserted per transaction, so the write lock is released regularly on large scans
+TODO_INSERT_BATCH_SIZE = 5000
 
 def add_to_todo(photo_paths):
     """Add photo paths to the todo database if they're not already there."""
     try:
-        with sqlite3.connect(TODO_DB) as conn:
-            cursor = conn.cursor()
-            # Use INSERT OR IGNORE to skip duplicates
-            cursor.executemany(
-                "INSERT OR IGNORE INTO todo_photos (photo_path) VALUES (?)",
-                [(str(path),) for path in photo_paths]
-            )
-            conn.commit()
+        path_iter = iter(photo_paths)
+        while True:
+            batch = list(islice(path_iter, TODO_INSERT_BATCH_SIZE))
+            if not batch:
+                break
+            with get_pool().writer() as conn:
+                cursor = conn.cursor()
+                # Use INSERT OR IGNORE to skip duplicates
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO todo_photos (photo_path) VALUES (?)",
+                    ((str(path),) for path in batch)
+                )
     except Exception as e:
         logger.error(f"Error adding paths to todo database: {e}")
 
 def read_todo_list():
     """Read pending photos from the todo database."""
     try:
-        with sqlite3.connect(TODO_DB) as conn:
+        with get_pool().reader() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT photo_path FROM todo_photos WHERE status = 'pending'")
-            todo_paths = [Path(row[0]) for row in cursor.fetchall()]
+            # photo_path is UNIQUE, so rows need no de-duplication
+            todo_paths = [row[0] for row in cursor]
             return todo_paths
     except Exception as e:
         logger.error(f"Error reading todo database: {e}")
@@ -100,7 +268,7 @@ def read_todo_list():
 def get_todo_stats():
     """Get statistics about todo items."""
     try:
-        with sqlite3.connect(TODO_DB) as conn:
+        with get_pool().reader() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT 
@@ -117,11 +285,10 @@ def get_todo_stats():
 def clear_todo_database():
     """Mark all entries in the todo database as completed."""
     try:
-        with sqlite3.connect(TODO_DB) as conn:
+        with get_pool().writer() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE todo_photos SET status = 'completed'")
             affected_rows = cursor.rowcount
-            conn.commit()
             return affected_rows
     except Exception as e:
         logger.error(f"Error clearing todo database: {e}")
@@ -130,7 +297,7 @@ def clear_todo_database():
 def list_pending_photos():
     """List all pending photos from the todo database."""
     try:
-        with sqlite3.connect(TODO_DB) as conn:
+        with get_pool().reader() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT photo_path, added_at 
@@ -151,28 +318,130 @@ def list_pending_photos():
         logger.error(f"Error listing pending photos: {e}")
 
 # File extensions for photos - now only JPEGs
-PHOTO_EXTENSIONS = {'.jpg', '.jpeg'}
+PHOTO_EXTENSIONS = frozenset({'.jpg', '.jpeg'})
+_PHOTO_SUFFIXES = tuple(PHOTO_EXTENSIONS)
+
+# Every JPEG starts with an SOI marker followed by another marker
+JPEG_MAGIC = b'\xff\xd8\xff'
+
+def _scan_one_level(directory):
+    """Return the (inode, path) JPEG photo pairs and the subdirectories directly inside directory."""
+    photo_suffixes = _PHOTO_SUFFIXES
+    photo_entries = []
+    subdirs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # macOS "._" AppleDouble resource forks share the photo's name but are not JPEGs
+            if entry.name.startswith('._'):
+                logger.debug(f"Skipping AppleDouble file: {entry.path}")
+                continue
+            try:
+                # d_type is cached on the entry, so these checks avoid a stat
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.lower().endswith(photo_suffixes):
+                    if entry.is_file(follow_symlinks=False):
+                        photo_entries.append((entry.inode(), entry.path))
+                    else:
+                        logger.debug(f"Skipping non-regular file: {entry.path}")
+            except OSError as e:
+                logger.warning(f"Skipping {entry.path}: {e}")
+    return photo_entries, subdirs
 
-def is_photo_file(file_path):
-    """Check if a file is a JPEG photo based on its extension."""
-    return Path(file_path).suffix.lower() in PHOTO_EXTENSIONS
+def iter_photos(directory):
+    """Lazily yield (inode, path) pairs for the JPEG photos found recursively in directory."""
+    # Depth-first walk with an explicit stack of directories still to scan
+    pending_dirs = [directory]
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
+        try:
+            photo_entries, subdirs = _scan_one_level(current_dir)
+        except OSError as e:
+            logger.warning(f"Cannot scan directory {current_dir}: {e}")
+            continue
+        pending_dirs.extend(subdirs)
+        yield from photo_entries
+
+def find_photos(directory):
+    """Return the JPEG photos below directory in inode order, walking top-level subdirectories in parallel."""
+    photo_entries, subdirs = _scan_one_level(directory)
+    
+    if len(subdirs) <= 1:
+        for subdir in subdirs:
+            photo_entries.extend(iter_photos(subdir))
+    else:
+        # Directory reads are I/O bound, so separate walks overlap their waits
+        with ThreadPoolExecutor(max_workers=min(32, len(subdirs))) as executor:
+            scan_tasks = [executor.submit(list, iter_photos(subdir)) for subdir in subdirs]
+            for future in as_completed(scan_tasks):
+                photo_entries.extend(future.result())
+    
+    # Reading files in inode order keeps disk access close to sequential
+    photo_entries.sort()
+    return [photo_path for _, photo_path in photo_entries]
+
+def is_valid_jpeg(photo_path):
+    """Check that a file has a JPEG header and can be parsed by Pillow, logging why not."""
+    from PIL import Image
+    
+    try:
+        file_obj = open(photo_path, 'rb')
+    except OSError as e:
+        logger.warning(f"Skipping unreadable file {photo_path}: {e}")
+        return False
+    
+    with file_obj:
+        try:
+            # Cheap magic-byte check before handing the file to Pillow
+            header = file_obj.read(len(JPEG_MAGIC))
+        except OSError as e:
+            logger.warning(f"Skipping unreadable file {photo_path}: {e}")
+            return False
+        if header != JPEG_MAGIC:
+            logger.warning(f"Skipping invalid JPEG: {photo_path}")
+            return False
+        
+        file_obj.seek(0)
+        try:
+            with Image.open(file_obj) as image:
+                image.verify()
+        except Image.DecompressionBombError:
+            # Only the headers are parsed here, so very large images are fine
+            return True
+        except (SyntaxError, OSError) as e:
+            # UnidentifiedImageError and decoder errors are both OSErrors
+            logger.warning(f"Skipping invalid JPEG {photo_path}: {e}")
+            return False
+    return True
+
+def filter_valid_jpegs(photo_paths):
+    """Return only the paths that are valid JPEGs, validating them concurrently."""
+    try:
+        # Import once up front so a missing Pillow doesn't fail inside every worker
+        import PIL.Image  # noqa: F401
+    except ImportError as e:
+        logger.warning(f"Pillow is not available, skipping JPEG validation: {e}")
+        return photo_paths
+    
+    with ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 2) as executor:
+        results = executor.map(is_valid_jpeg, photo_paths)
+        return [photo_path for photo_path, valid in zip(photo_paths, results) if valid]
 
 def scan_directory(directory):
     """Scan directory recursively for JPEG photos and return a list of photo paths."""
-    photo_paths = []
-    directory_path = Path(directory)
+    logger.info(f"Scanning directory recursively: {directory}")
     
-    if not directory_path.exists():
+    # Let the first scandir report a missing directory instead of stat-ing it up front
+    try:
+        photo_paths = find_photos(directory)
+    except (FileNotFoundError, NotADirectoryError):
         logger.error(f"Directory not found: {directory}")
         return []
-        
-    logger.info(f"Scanning directory recursively: {directory}")
+    except OSError as e:
+        logger.error(f"Cannot scan directory {directory}: {e}")
+        return []
     
-    for root, _, files in os.walk(directory):
-        for filename in files:
-            file_path = Path(root) / filename
-            if is_photo_file(file_path):
-                photo_paths.append(file_path)
+    photo_paths = filter_valid_jpegs(photo_paths)
     
     logger.info(f"Found {len(photo_paths)} JPEG photos")
     return photo_paths
@@ -183,12 +452,15 @@ def get_password(username, password=None):
     if password:
         return password
     
-    # Prompt user for password
+    # Prompt user for password once pending log output has been written
+    flush_logging()
     entered_password = getpass.getpass(f"Enter iCloud password for {username}: ")
     return entered_password
 
 def authenticate_icloud(username, password=None):
     """Authenticate with iCloud."""
+    from pyicloud import PyiCloudService
+    
     password = get_password(username, password)
 
     logger.info(f"Authenticating to iCloud as {username}")
@@ -196,6 +468,7 @@ def authenticate_icloud(username, password=None):
     
     if api.requires_2fa:
         logger.info("Two-factor authentication required.")
+        flush_logging()
         code = input("Enter the verification code: ")
         result = api.validate_2fa_code(code)
         logger.info(f"2FA validation result: {result}")
@@ -206,18 +479,91 @@ def authenticate_icloud(username, password=None):
     
     return api
 
+def configure_connection_pool(api, threads):
+    """Size the iCloud session's HTTPS connection pool for the upload threads."""
+    from requests.adapters import HTTPAdapter
+    
+    # The default pool keeps only 10 connections alive, so extra threads would
+    # keep evicting each other's connections and pay a new TLS handshake.
+    # No adapter-level retries: upload_photo() owns retrying failed uploads.
+    pool_size = threads * 2
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    api.session.mount('https://', adapter)
+
+def is_retryable_error(error):
+    """Check if an upload failed before iCloud could have stored the photo."""
+    from pyicloud.exceptions import PyiCloudAPIResponseException
+    from requests.exceptions import ConnectionError as RequestsConnectionError
+    from urllib3.exceptions import NewConnectionError
+    
+    if isinstance(error, RequestsConnectionError):
+        # Only a failure to connect proves the body was never sent; a dropped
+        # connection after sending may still have created the asset
+        cause = error.args[0] if error.args else None
+        return isinstance(getattr(cause, 'reason', None), NewConnectionError)
+    if isinstance(error, PyiCloudAPIResponseException):
+        return error.code in RETRYABLE_ERROR_CODES
+    return False
+
 def upload_photo(api, photo_path):
     """Upload a single photo to iCloud Camera Roll and remove from todo list if successful."""
+    for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+        try:
+            # Upload to Camera Roll
+            api.photos.upload_file(photo_path)
+            
+            # If upload was successful, remove from todo list
+            remove_from_todo(photo_path)
+            return True
+        except Exception as e:
+            if attempt == UPLOAD_ATTEMPTS or not is_retryable_error(e):
+                logger.error(f"Error uploading {photo_path}: {e}")
+                return False
+            
+            # Exponential backoff with jitter so threads don't retry in lockstep
+            delay = min(MAX_RETRY_DELAY, 2 ** attempt) + random.random()
+            logger.warning(f"Upload of {photo_path} failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def run_uploads(api, photos, threads):
+    """Upload photos concurrently and return (successful, failed) counts."""
+    completion_writer = start_completion_writer()
     try:
-        # Upload to Camera Roll
-        api.photos.upload_file(photo_path)
+        return _collect_uploads(api, photos, threads)
+    finally:
+        stop_completion_writer(completion_writer)
+
+def _collect_uploads(api, photos, threads):
+    """Submit uploads to a thread pool and tally results as they finish."""
+    from tqdm import tqdm
+    
+    successful = 0
+    failed = 0
+    
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        # Create upload tasks
+        upload_tasks = {
+            executor.submit(upload_photo, api, photo): photo
+            for photo in photos
+        }
         
-        # If upload was successful, remove from todo list
-        remove_from_todo(photo_path)
-        return True
-    except Exception as e:
-        logger.error(f"Error uploading {photo_path}: {e}")
-        return False
+        # Process results with progress bar, in completion order
+        with tqdm(total=len(photos), desc="Uploading") as pbar:
+            for future in as_completed(upload_tasks):
+                photo = upload_tasks[future]
+                try:
+                    result = future.result()
+                    if result:
+                        successful += 1
+                    else:
+                        failed += 1
+                except Exception as e:
+                    logger.error(f"Error processing {photo}: {e}")
+                    failed += 1
+                finally:
+                    pbar.update(1)
+    
+    return successful, failed
 
 def main():
     """Main function to parse arguments and run the uploader."""
@@ -233,7 +579,8 @@ def main():
     
     parser.add_argument('--username', '-u', help='iCloud username/email')
     parser.add_argument('--password', '-p', help='iCloud password (if not provided, will prompt)')
-    parser.add_argument('--threads', '-t', type=int, default=5, help='Number of upload threads (default: 5)')
+    parser.add_argument('--threads', '-t', type=int, default=DEFAULT_THREADS,
+                       help=f'Number of upload threads (default: {DEFAULT_THREADS}, based on CPU count)')
     parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose logging')
     parser.add_argument('--todo-db', '-f', default=DEFAULT_TODO_DB, 
                        help=f'Path to the todo database file (default: {DEFAULT_TODO_DB})')
@@ -247,18 +594,11 @@ def main():
     TODO_DB = args.todo_db
     GENERAL_LOG = args.general_log
     
+    configure_logging(GENERAL_LOG, args.verbose)
+    
     # Initialize the database
     init_database()
     
-    # Reconfigure logging with new file paths
-    for handler in logger.handlers[:]:
-        logger.removeHandler(handler)
-    logger.addHandler(logging.StreamHandler())
-    logger.addHandler(logging.FileHandler(GENERAL_LOG))
-    
-    if args.verbose:
-        logger.setLevel(logging.DEBUG)
-    
     # Show stats if requested
     if args.stats:
         stats = get_todo_stats()
@@ -308,34 +648,12 @@ def main():
         logger.error("Authentication failed. Exiting.")
         return 1
     
-    # Upload photos
-    logger.info(f"Starting upload of {len(photos)} JPEG photos to Camera Roll")
+    configure_connection_pool(api, args.threads)
     
-    successful = 0
-    failed = 0
+    # Upload photos
+    logger.info(f"Starting upload of {len(photos)} JPEG photos to Camera Roll using {args.threads} threads")
     
-    with ThreadPoolExecutor(max_workers=args.threads) as executor:
-        # Create upload tasks
-        upload_tasks = {
-            executor.submit(upload_photo, api, photo): photo
-            for photo in photos
-        }
-        
-        # Process results with progress bar
-        with tqdm(total=len(photos), desc="Uploading") as pbar:
-            for future in upload_tasks:
-                photo = upload_tasks[future]
-                try:
-                    result = future.result()
-                    if result:
-                        successful += 1
-                    else:
-                        failed += 1
-                except Exception as e:
-                    logger.error(f"Error processing {photo}: {e}")
-                    failed += 1
-                finally:
-                    pbar.update(1)
+    successful, failed = run_uploads(api, photos, args.threads)
     
     # Final report
     stats = get_todo_stats()